@@ -12,6 +12,9 @@ nlm_generator = False
 
 commit_barrier = 0
 gc_timeout = 60
+# threads to read sysfs attributes in the old kernels compat
+# code, 0 -- read them sequentially
+compat_sysfs_workers = 0
 
 # save uname() on startup time: it is not so
 # highly possible that the kernel will be
@@ -319,7 +319,8 @@ class NetlinkMixin(object):
         self.capabilities = {'create_bridge': config.kernel > [3, 2, 0],
                              'create_bond': config.kernel > [3, 2, 0],
                              'create_dummy': True,
-                             'provide_master': config.kernel[0] > 2}
+                             'provide_master': config.kernel[0] > 2,
+                             'provide_linkinfo': config.kernel >= [3, 3, 0]}
         self.backlog_lock = threading.Lock()
         self.read_lock = threading.Lock()
         self.sys_lock = threading.Lock()
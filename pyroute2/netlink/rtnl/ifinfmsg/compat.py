@@ -1,19 +1,28 @@
 import os
 import json
+import time
 import errno
 import select
 import struct
+import logging
 import threading
 import subprocess
 from fcntl import ioctl
 from pyroute2 import config
+from pyroute2.proxy import error_verdict
 from pyroute2.common import map_enoent
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_REQUEST
 from pyroute2.netlink.rtnl import RTM_VALUES
+from pyroute2.netlink.rtnl import RTMGRP_LINK
 from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+from pyroute2.netlink.rtnl.ifinfmsg import IFF_UP
 from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
 from pyroute2.netlink.exceptions import NetlinkError
 from pyroute2.netlink.rtnl.riprsocket import RawIPRSocket
 
+log = logging.getLogger(__name__)
+
 
 # it's simpler to double constants here, than to change all the
 # module layout; but it is a subject of the future refactoring
@@ -23,8 +32,12 @@ RTM_DELLINK = 17
 
 _BONDING_MASTERS = '/sys/class/net/bonding_masters'
 _BONDING_SLAVES = '/sys/class/net/%s/bonding/slaves'
+_BONDING_DIR = '/sys/class/net/%s/bonding'
+_BRIDGE_DIR = '/sys/class/net/%s/bridge'
 _BRIDGE_MASTER = '/sys/class/net/%s/brport/bridge/ifindex'
 _BONDING_MASTER = '/sys/class/net/%s/master/ifindex'
+_SYSFS_POOL_MIN = 8
+_SYNC_TIMEOUT = 5
 IFNAMSIZ = 16
 
 TUNDEV = '/dev/net/tun'
@@ -58,13 +71,221 @@ IFT_DETACH_QUEUE = 0x0400
 IFT_PERSIST = 0x0800
 IFT_NOFILTER = 0x1000
 
+# Marshal.parse() keeps no state between calls, so one
+# instance can be shared by all proxy_linkinfo() calls
+_marshal = MarshalRtnl()
+
+# guards the lazily created module globals below
+_init_lock = threading.Lock()
+_devnull_fd = None
+_sysfs_pool = None
+# Python < 3.3 has no dir_fd support
+_OPENAT = os.open in getattr(os, 'supports_dir_fd', ())
+
+try:
+    _pread = os.pread
+except AttributeError:
+    # Python < 3.3
+    def _pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def _devnull():
+    '''
+    Return the /dev/null fd for external utilities output, open
+    it on the first call.
+
+    close_fds=False is safe with this fd, since Python >= 3.4
+    creates non-inheritable fds, and Python 2 doesn't close fds
+    by default anyway.
+    '''
+    global _devnull_fd
+    with _init_lock:
+        if _devnull_fd is None:
+            _devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    return _devnull_fd
+
+
+def _sysfs_read_fd(fd):
+    '''
+    Read a sysfs attribute from `fd` with raw syscalls, bypassing
+    Python IO buffering and decoding, and close the fd.
+    '''
+    try:
+        return _pread(fd, 4096, 0)
+    finally:
+        os.close(fd)
+
+
+def _sysfs_read(path):
+    '''
+    Read a sysfs attribute by the path.
+
+    The fd is not kept between calls: /sys/class/net paths go
+    through symlinks, that are resolved at open(), so an fd
+    cached by the path may point to another interface after
+    a rename, or to an old master after the port is moved.
+    '''
+    return _sysfs_read_fd(os.open(path, os.O_RDONLY))
+
+
+# IFLA_INFO_DATA NLA -> sysfs attribute, where the attribute is not
+# just the NLA name without the prefix; None -- no readable sysfs
+# attribute with an integer value
+_SYSFS_NAMES = {'IFLA_BR_ROOT_ID': None,
+                'IFLA_BR_BRIDGE_ID': None,
+                'IFLA_BR_GROUP_ADDR': None,
+                'IFLA_BR_FDB_FLUSH': None,
+                'IFLA_BR_PAD': None,
+                'IFLA_BR_VLAN_DEFAULT_PVID': 'default_pvid',
+                'IFLA_BR_MCAST_ROUTER': 'multicast_router',
+                'IFLA_BR_MCAST_SNOOPING': 'multicast_snooping',
+                'IFLA_BR_MCAST_QUERY_USE_IFADDR':
+                'multicast_query_use_ifaddr',
+                'IFLA_BR_MCAST_QUERIER': 'multicast_querier',
+                'IFLA_BR_MCAST_HASH_ELASTICITY': 'hash_elasticity',
+                'IFLA_BR_MCAST_HASH_MAX': 'hash_max',
+                'IFLA_BR_MCAST_LAST_MEMBER_CNT':
+                'multicast_last_member_count',
+                'IFLA_BR_MCAST_STARTUP_QUERY_CNT':
+                'multicast_startup_query_count',
+                'IFLA_BR_MCAST_LAST_MEMBER_INTVL':
+                'multicast_last_member_interval',
+                'IFLA_BR_MCAST_MEMBERSHIP_INTVL':
+                'multicast_membership_interval',
+                'IFLA_BR_MCAST_QUERIER_INTVL': 'multicast_querier_interval',
+                'IFLA_BR_MCAST_QUERY_INTVL': 'multicast_query_interval',
+                'IFLA_BR_MCAST_QUERY_RESPONSE_INTVL':
+                'multicast_query_response_interval',
+                'IFLA_BR_MCAST_STARTUP_QUERY_INTVL':
+                'multicast_startup_query_interval',
+                'IFLA_BR_MCAST_STATS_ENABLED': 'multicast_stats_enabled',
+                'IFLA_BR_MCAST_IGMP_VERSION': 'multicast_igmp_version',
+                'IFLA_BR_MCAST_MLD_VERSION': 'multicast_mld_version',
+                'IFLA_BOND_ACTIVE_SLAVE': None,
+                'IFLA_BOND_PRIMARY': None,
+                'IFLA_BOND_ARP_IP_TARGET': None,
+                'IFLA_BOND_AD_INFO': None,
+                'IFLA_BOND_AD_ACTOR_SYSTEM': None,
+                'IFLA_BOND_NUM_PEER_NOTIF': 'num_grat_arp',
+                'IFLA_BOND_AD_LACP_RATE': 'lacp_rate'}
+
+
+def _sysfs_attrs(kind, directory, prefix):
+    '''
+    Map IFLA_INFO_DATA NLA names of the `kind` to sysfs attribute
+    names in `directory`: `_SYSFS_NAMES` entries, or the NLA names
+    without `prefix`. Placeholder NLAs are skipped.
+    '''
+    cmds = []
+    names = []
+    for x in ifinfmsg.ifinfo.data_map[kind].nla_map:
+        if x[0].startswith(prefix) and x[1] != 'none':
+            name = _SYSFS_NAMES.get(x[0], x[0][len(prefix):].lower())
+            if name is not None:
+                cmds.append(x[0])
+                names.append(name)
+    return (directory, tuple(cmds), tuple(names))
+
+
+# kind -> (sysfs directory, NLA names, sysfs attribute names)
+_SYSFS_ATTRS = {'bridge': _sysfs_attrs('bridge', _BRIDGE_DIR, 'IFLA_BR_'),
+                'bond': _sysfs_attrs('bond', _BONDING_DIR, 'IFLA_BOND_')}
+# kind -> {NLA name: sysfs attribute name}
+_SYSFS_NAMES_MAP = dict((kind, dict(zip(x[1], x[2])))
+                        for (kind, x) in _SYSFS_ATTRS.items())
+
+
+def _get_sysfs_pool():
+    global _sysfs_pool
+    with _init_lock:
+        # the pool threads don't survive fork(), so a child
+        # must not reuse the pool inherited from the parent
+        if _sysfs_pool is None or _sysfs_pool[0] != os.getpid():
+            # import on demand, the pool is disabled by default
+            from multiprocessing.pool import ThreadPool
+            _sysfs_pool = (os.getpid(),
+                           ThreadPool(config.compat_sysfs_workers))
+    return _sysfs_pool[1]
+
+
+def _sysfs_read_batch(directory, names):
+    '''
+    Read several attributes from one sysfs directory.
+
+    The directory is resolved only once, and the attributes are
+    opened relative to it with `openat()`, so the /sys/class/net
+    symlinks are not walked for every attribute.
+
+    If `config.compat_sysfs_workers` is set, and there are at least
+    `_SYSFS_POOL_MIN` names, the attributes are read concurrently
+    in a thread pool of that size.
+
+    Returns a list of values in the order of `names`, `None` for
+    attributes that can not be read.
+    '''
+    if _OPENAT:
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            return [None] * len(names)
+    else:
+        dir_fd = None
+
+    def read(name):
+        try:
+            if dir_fd is None:
+                fd = os.open('%s/%s' % (directory, name), os.O_RDONLY)
+            else:
+                fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+            return _sysfs_read_fd(fd)
+        except (IOError, OSError):
+            return None
+
+    try:
+        if config.compat_sysfs_workers and len(names) >= _SYSFS_POOL_MIN:
+            return _get_sysfs_pool().map(read, names)
+        return [read(x) for x in names]
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def _sysfs_store(path, *data):
+    '''
+    Write strings into a sysfs file without Python IO buffering.
 
-def compat_fix_attrs(msg, nl):
+    Every string goes with a separate write() call, since sysfs
+    handles each write() as one command. Raises OSError on failure.
+    '''
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for item in data:
+            os.write(fd, item.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def _sysfs_write(path, value):
+    '''
+    Write a value into a sysfs attribute.
+
+    Returns 0 on success or errno on failure.
+    '''
+    try:
+        _sysfs_store(path, str(value))
+    except OSError as e:
+        return e.errno
+    return 0
+
+
+def compat_fix_attrs(msg, provide_master):
     kind = None
     ifname = msg.get_attr('IFLA_IFNAME')
 
     # fix master
-    if not nl.capabilities['provide_master']:
+    if not provide_master:
         master = compat_get_master(ifname)
         if master is not None:
             msg['attrs'].append(['IFLA_MASTER', master])
@@ -78,31 +299,27 @@ def compat_fix_attrs(msg, nl):
             li['attrs'].append(['IFLA_INFO_KIND', kind])
     elif 'attrs' in msg:
         kind = get_interface_type(ifname)
-        msg['attrs'].append(['IFLA_LINKINFO',
-                             {'attrs': [['IFLA_INFO_KIND', kind]]}])
+        li = {'attrs': [['IFLA_INFO_KIND', kind]]}
+        msg['attrs'].append(['IFLA_LINKINFO', li])
     else:
         return
 
-    li = msg.get_attr('IFLA_LINKINFO')
-    # fetch specific interface data
-
-    if (kind in ('bridge', 'bond')) and \
-            [x for x in li['attrs'] if x[0] == 'IFLA_INFO_DATA']:
-        if kind == 'bridge':
-            t = '/sys/class/net/%s/bridge/%s'
-            ifdata = ifinfmsg.ifinfo.bridge_data
-        elif kind == 'bond':
-            t = '/sys/class/net/%s/bonding/%s'
-            ifdata = ifinfmsg.ifinfo.bond_data
+    # fetch specific interface data, if the kernel doesn't provide it
 
+    if (kind in _SYSFS_ATTRS) and \
+            not any(x[0] == 'IFLA_INFO_DATA' for x in li['attrs']):
+        (t, cmds, names) = _SYSFS_ATTRS[kind]
+        values = _sysfs_read_batch(t % (ifname), names)
         commands = []
-        for cmd, _ in ifdata.nla_map:
+        for cmd, value in zip(cmds, values):
+            if value is None:
+                continue
             try:
-                with open(t % (ifname, ifdata.nla2name(cmd)), 'r') as f:
-                    value = f.read()
-                if cmd == 'IFLA_BOND_MODE':
-                    value = value.split()[1]
-                commands.append([cmd, int(value)])
+                # int() parses bytes, no need to decode; bond
+                # enumerations are like b'balance-rr 0\n', and
+                # masks like b'0x0\n'
+                value = value[value.rfind(b' ') + 1:]
+                commands.append([cmd, int(value, 0)])
             except:
                 pass
         if commands:
@@ -111,18 +328,26 @@ def compat_fix_attrs(msg, nl):
 
 def proxy_linkinfo(data, nl):
 
-    marshal = MarshalRtnl()
-    inbox = marshal.parse(data)
-    data = b''
+    # nl is a Namespace, so every attribute access is a Python
+    # call; read the capabilities once per call, not per message
+    caps = nl.capabilities
+    provide_master = caps['provide_master']
+    # nothing to fix, don't parse and re-encode the data
+    if provide_master and caps['provide_linkinfo']:
+        return {'verdict': 'forward',
+                'data': data}
+
+    inbox = _marshal.parse(data)
+    parts = []
     for msg in inbox:
         if msg['event'] == 'NLMSG_ERROR':
-            data += msg.data
+            parts.append(msg.data)
             continue
         # Sysfs operations can require root permissions,
         # but the script can be run under a normal user
         # Bug-Url: https://github.com/svinota/pyroute2/issues/113
         try:
-            compat_fix_attrs(msg, nl)
+            compat_fix_attrs(msg, provide_master)
         except OSError:
             # We can safely ignore here any OSError.
             # In the worst case, we just return what we have got
@@ -131,23 +356,58 @@ def proxy_linkinfo(data, nl):
 
         msg.reset()
         msg.encode()
-        data += msg.data
+        parts.append(msg.data)
 
     return {'verdict': 'forward',
-            'data': data}
+            'data': b''.join(parts)}
 
 
-def proxy_setlink(imsg, nl):
+def _get_interface(nl, index):
+    msg = nl.get_links(index)[0]
+    try:
+        kind = msg.get_attr('IFLA_LINKINFO').get_attr('IFLA_INFO_KIND')
+    except AttributeError:
+        kind = 'unknown'
+    return {'ifname': msg.get_attr('IFLA_IFNAME'),
+            'master': msg.get_attr('IFLA_MASTER'),
+            'kind': kind}
+
+
+def _get_port_setup(msg, nl):
+    '''
+    Resolve the port setup request, if any.
+
+    Returns `(cmd, master)`, where `cmd` is 'add' or 'del', and
+    `master` is the `_get_interface()` dict; `None` if the message
+    doesn't touch IFLA_MASTER.
+    '''
+    master = msg.get_attr('IFLA_MASTER')
+    if master is None:
+        return None
+
+    if master == 0:
+        # port delete
+        # 1. get the current master
+        iface = _get_interface(nl, msg['index'])
+        return ('del', _get_interface(nl, iface['master']))
+    else:
+        # port add
+        # 1. get the master
+        return ('add', _get_interface(nl, master))
 
-    def get_interface(index):
-        msg = nl.get_links(index)[0]
-        try:
-            kind = msg.get_attr('IFLA_LINKINFO').get_attr('IFLA_INFO_KIND')
-        except AttributeError:
-            kind = 'unknown'
-        return {'ifname': msg.get_attr('IFLA_IFNAME'),
-                'master': msg.get_attr('IFLA_MASTER'),
-                'kind': kind}
+
+def _manage_port(cmd, master, ifname, nl):
+    # 2. manage the port
+    forward_map = {'team': manage_team_port,
+                   'bridge': compat_bridge_port,
+                   'bond': compat_bond_port}
+    if master['kind'] in forward_map:
+        func = forward_map[master['kind']]
+        return func(cmd, master['ifname'], ifname, nl)
+    return True
+
+
+def proxy_setlink(imsg, nl):
 
     msg = ifinfmsg(imsg.data)
     msg.decode()
@@ -157,7 +417,7 @@ def proxy_setlink(imsg, nl):
     infodata = None
 
     ifname = msg.get_attr('IFLA_IFNAME') or \
-        get_interface(msg['index'])['ifname']
+        _get_interface(nl, msg['index'])['ifname']
     linkinfo = msg.get_attr('IFLA_LINKINFO')
     if linkinfo:
         kind = linkinfo.get_attr('IFLA_INFO_KIND')
@@ -171,9 +431,13 @@ def proxy_setlink(imsg, nl):
         elif kind == 'bridge':
             func = compat_set_bridge
         #
+        names = _SYSFS_NAMES_MAP[kind]
         for (cmd, value) in infodata.get('attrs', []):
-            cmd = infodata.nla2name(cmd)
-            code = func(ifname, cmd, value) or code
+            if cmd in names:
+                code = func(ifname, names[cmd], value) or code
+            else:
+                # no writable sysfs attribute for this NLA
+                code = errno.EOPNOTSUPP
         #
         if code:
             err = OSError()
@@ -181,34 +445,109 @@ def proxy_setlink(imsg, nl):
             raise err
 
     # is it a port setup?
-    master = msg.get_attr('IFLA_MASTER')
-    if master is not None:
-
-        if master == 0:
-            # port delete
-            # 1. get the current master
-            iface = get_interface(msg['index'])
-            master = get_interface(iface['master'])
-            cmd = 'del'
-        else:
-            # port add
-            # 1. get the master
-            master = get_interface(master)
-            cmd = 'add'
-
-        # 2. manage the port
-        forward_map = {'team': manage_team_port,
-                       'bridge': compat_bridge_port,
-                       'bond': compat_bond_port}
-        if master['kind'] in forward_map:
-            func = forward_map[master['kind']]
-            forward = func(cmd, master['ifname'], ifname, nl)
+    port = _get_port_setup(msg, nl)
+    if port is not None:
+        forward = _manage_port(port[0], port[1], ifname, nl)
 
     if forward is not None:
         return {'verdict': 'forward',
                 'data': imsg.data}
 
 
+def proxy_setlink_batch(imsgs, nl):
+    '''
+    Process a list of RTM_SETLINK requests.
+
+    Consecutive bond port add/del requests for the same master
+    are grouped, so the bond slaves file is opened only once per
+    group. All other requests go through `proxy_setlink()`.
+    The order of the requests is preserved: a group is written
+    before any other request, and before a port of the group is
+    looked up again, so the result is the same as of the
+    requests processed one by one.
+
+    Returns the list of `proxy_setlink()` results, one per request.
+    A failed request gets the NetlinkProxy error verdict, and
+    doesn't affect the rest of the batch.
+    '''
+    ret = []
+    # the current group: master ifname, [(cmd, ifname, request idx)]
+    group = [None, []]
+    create_bond = nl.capabilities['create_bond']
+
+    def flush():
+        (master, commands) = group
+        if commands:
+            errors = compat_bond_ports(master,
+                                       [x[:2] for x in commands])
+            for ((cmd, ifname, idx), error) in zip(commands, errors):
+                if error is not None:
+                    ret[idx] = error_verdict(imsgs[idx], error)
+        group[:] = [None, []]
+
+    for (idx, imsg) in enumerate(imsgs):
+        try:
+            msg = ifinfmsg(imsg.data)
+            msg.decode()
+            if msg.get_attr('IFLA_LINKINFO') is not None or \
+                    msg.get_attr('IFLA_MASTER') is None:
+                flush()
+                ret.append(proxy_setlink(imsg, nl))
+                continue
+
+            ifname = msg.get_attr('IFLA_IFNAME') or \
+                _get_interface(nl, msg['index'])['ifname']
+            if any(x[1] == ifname for x in group[1]):
+                # the port master lookup must see the pending writes
+                flush()
+            cmd, master = _get_port_setup(msg, nl)
+            if master['kind'] == 'bond' and not create_bond:
+                if master['ifname'] != group[0]:
+                    flush()
+                    group[0] = master['ifname']
+                group[1].append((cmd, ifname, idx))
+                ret.append(None)
+                continue
+
+            flush()
+            if _manage_port(cmd, master, ifname, nl) is not None:
+                ret.append({'verdict': 'forward',
+                            'data': imsg.data})
+            else:
+                ret.append(None)
+        except Exception as e:
+            ret.append(error_verdict(imsg, e))
+
+    flush()
+    return ret
+
+
+def _wait_event(ipr, event, ifname, timeout):
+    '''
+    Wait for an `event` about `ifname` on the bound socket `ipr`,
+    but not longer than `timeout` seconds.
+
+    Returns True if the event is received, False on timeout.
+    '''
+    deadline = time.time() + timeout
+    # level-triggered: ipr.get() reads only one datagram per
+    # wakeup, and EPOLLET would leave the rest in the queue
+    # until the next event
+    ep = select.epoll()
+    try:
+        ep.register(ipr.fileno(), select.EPOLLIN | select.EPOLLPRI)
+        while True:
+            left = deadline - time.time()
+            if left <= 0 or not ep.poll(left):
+                return False
+            for msg in ipr.get():
+                if msg.get('event') == event and \
+                        msg.get_attr('IFLA_IFNAME') == ifname:
+                    return True
+    finally:
+        ep.close()
+
+
 def sync(f):
     '''
     A decorator to wrap up external utility calls.
@@ -216,51 +555,30 @@ def sync(f):
     A decorated function receives a netlink message
     as a parameter, and then:
 
-    1. Starts a monitoring thread
+    1. Binds an RTNL socket to the link events group
     2. Performs the external call
-    3. Waits for a netlink event specified by `msg`
-    4. Joins the monitoring thread
+    3. Waits for a netlink event specified by `msg`,
+       but not longer than `_SYNC_TIMEOUT` seconds
+    4. Closes the socket
+
+    The socket is bound in the calling thread before the
+    external call, so it belongs to the same network namespace
+    as the utility, and the event can not be missed: it waits
+    in the socket buffer until it is read.
 
     If the wrapped function raises an exception, the
-    monitoring thread will be forced to stop via the
-    control channel pipe. The exception will be then
-    forwarded.
+    socket is closed and the exception is forwarded.
     '''
-    def monitor(event, ifname, cmd):
-        with RawIPRSocket() as ipr:
-            poll = select.poll()
-            poll.register(ipr, select.POLLIN | select.POLLPRI)
-            poll.register(cmd, select.POLLIN | select.POLLPRI)
-            ipr.bind()
-            while True:
-                events = poll.poll()
-                for (fd, event) in events:
-                    if fd == ipr.fileno():
-                        msgs = ipr.get()
-                        for msg in msgs:
-                            if msg.get('event') == event and \
-                                    msg.get_attr('IFLA_IFNAME') == ifname:
-                                return
-                    else:
-                        return
-
     def decorated(msg):
-        rcmd, cmd = os.pipe()
-        t = threading.Thread(target=monitor,
-                             args=(RTM_VALUES[msg['header']['type']],
-                                   msg.get_attr('IFLA_IFNAME'),
-                                   rcmd))
-        t.start()
-        ret = None
-        try:
+        event = RTM_VALUES[msg['header']['type']]
+        ifname = msg.get_attr('IFLA_IFNAME')
+        with RawIPRSocket() as ipr:
+            # only link events are awaited, don't parse the rest
+            ipr.bind(groups=RTMGRP_LINK)
             ret = f(msg)
-        except Exception:
-            raise
-        finally:
-            os.write(cmd, b'q')
-            t.join()
-            os.close(rcmd)
-            os.close(cmd)
+            if not _wait_event(ipr, event, ifname, _SYNC_TIMEOUT):
+                log.warning('%s for %s was not received in %s seconds',
+                            event, ifname, _SYNC_TIMEOUT)
         return ret
 
     return decorated
@@ -298,10 +616,8 @@ def proxy_newlink(imsg, nl):
     # get the interface kind
     linkinfo = msg.get_attr('IFLA_LINKINFO')
     if linkinfo is not None:
-        kind = [x[1] for x in linkinfo['attrs']
-                if x[0] == 'IFLA_INFO_KIND']
-        if kind:
-            kind = kind[0]
+        kind = next((x[1] for x in linkinfo['attrs']
+                     if x[0] == 'IFLA_INFO_KIND'), None)
 
     if kind == 'tuntap':
         return manage_tuntap(msg)
@@ -327,19 +643,19 @@ def manage_team(msg):
               'runner': {'name': 'activebackup'},
               'link_watch': {'name': 'ethtool'}}
 
-    with open(os.devnull, 'w') as fnull:
-        subprocess.check_call(['teamd', '-d', '-n', '-c', json.dumps(config)],
-                              stdout=fnull,
-                              stderr=fnull)
+    subprocess.check_call(['teamd', '-d', '-n', '-c', json.dumps(config)],
+                          stdout=_devnull(),
+                          stderr=_devnull(),
+                          close_fds=False)
 
 
 @map_enoent
 def manage_team_port(cmd, master, ifname, nl):
-    with open(os.devnull, 'w') as fnull:
-        subprocess.check_call(['teamdctl', master, 'port',
-                               'remove' if cmd == 'del' else 'add', ifname],
-                              stdout=fnull,
-                              stderr=fnull)
+    subprocess.check_call(['teamdctl', master, 'port',
+                           'remove' if cmd == 'del' else 'add', ifname],
+                          stdout=_devnull(),
+                          stderr=_devnull(),
+                          close_fds=False)
 
 
 @sync
@@ -371,12 +687,13 @@ def manage_tuntap(msg):
             ifru_flags |= IFT_VNET_HDR
         if flags['multi_queue']:
             ifru_flags |= IFT_MULTI_QUEUE
-    ifr = msg.get_attr('IFLA_IFNAME')
-    if len(ifr) > IFNAMSIZ:
+    ifname = msg.get_attr('IFLA_IFNAME').encode('ascii')
+    if len(ifname) > IFNAMSIZ:
         raise ValueError('ifname too long')
-    ifr += (IFNAMSIZ - len(ifr)) * '\0'
-    ifr = ifr.encode('ascii')
-    ifr += struct.pack('H', ifru_flags)
+    # struct ifreq: zero padded ifr_name + ifr_flags
+    ifr = bytearray(IFNAMSIZ + 2)
+    ifr[:len(ifname)] = ifname
+    struct.pack_into('H', ifr, IFNAMSIZ, ifru_flags)
 
     user = infodata.get_attr('IFTUN_UID')
     group = infodata.get_attr('IFTUN_GID')
@@ -398,94 +715,116 @@ def manage_tuntap(msg):
 @sync
 def compat_create_bridge(msg):
     name = msg.get_attr('IFLA_IFNAME')
-    with open(os.devnull, 'w') as fnull:
-        subprocess.check_call(['brctl', 'addbr', name],
-                              stdout=fnull,
-                              stderr=fnull)
+    subprocess.check_call(['brctl', 'addbr', name],
+                          stdout=_devnull(),
+                          stderr=_devnull(),
+                          close_fds=False)
 
 
 @sync
 def compat_create_bond(msg):
     name = msg.get_attr('IFLA_IFNAME')
-    with open(_BONDING_MASTERS, 'w') as f:
-        f.write('+%s' % (name))
+    _sysfs_store(_BONDING_MASTERS, '+%s' % (name))
 
 
 def compat_set_bond(name, cmd, value):
-    # FIXME: join with bridge
-    # FIXME: use internal IO, not bash
-    t = 'echo %s >/sys/class/net/%s/bonding/%s'
-    with open(os.devnull, 'w') as fnull:
-        return subprocess.call(['bash', '-c', t % (value, name, cmd)],
-                               stdout=fnull,
-                               stderr=fnull)
+    return _sysfs_write('%s/%s' % (_BONDING_DIR % (name), cmd), value)
 
 
 def compat_set_bridge(name, cmd, value):
-    t = 'echo %s >/sys/class/net/%s/bridge/%s'
-    with open(os.devnull, 'w') as fnull:
-        return subprocess.call(['bash', '-c', t % (value, name, cmd)],
-                               stdout=fnull,
-                               stderr=fnull)
+    return _sysfs_write('%s/%s' % (_BRIDGE_DIR % (name), cmd), value)
+
+
+def _link_down(index):
+    # not nl.link(): nl requests go through the NetlinkProxy,
+    # that holds its lock while proxy_dellink() runs
+    msg = ifinfmsg()
+    msg['index'] = index
+    msg['change'] = IFF_UP
+    with RawIPRSocket() as ipr:
+        tuple(ipr.nlm_request(msg, RTM_NEWLINK,
+                              NLM_F_REQUEST | NLM_F_ACK))
 
 
 @sync
 def compat_del_bridge(msg):
     name = msg.get_attr('IFLA_IFNAME')
-    with open(os.devnull, 'w') as fnull:
-        subprocess.check_call(['ip', 'link', 'set',
-                               'dev', name, 'down'])
-        subprocess.check_call(['brctl', 'delbr', name],
-                              stdout=fnull,
-                              stderr=fnull)
+    _link_down(msg['index'])
+    subprocess.check_call(['brctl', 'delbr', name],
+                          stdout=_devnull(),
+                          stderr=_devnull(),
+                          close_fds=False)
 
 
 @sync
 def compat_del_bond(msg):
     name = msg.get_attr('IFLA_IFNAME')
-    subprocess.check_call(['ip', 'link', 'set',
-                           'dev', name, 'down'])
-    with open(_BONDING_MASTERS, 'w') as f:
-        f.write('-%s' % (name))
+    _link_down(msg['index'])
+    _sysfs_store(_BONDING_MASTERS, '-%s' % (name))
 
 
 def compat_bridge_port(cmd, master, port, nl):
     if nl.capabilities['create_bridge']:
         return True
-    with open(os.devnull, 'w') as fnull:
-        subprocess.check_call(['brctl', '%sif' % (cmd), master, port],
-                              stdout=fnull,
-                              stderr=fnull)
+    subprocess.check_call(['brctl', '%sif' % (cmd), master, port],
+                          stdout=_devnull(),
+                          stderr=_devnull(),
+                          close_fds=False)
 
 
 def compat_bond_port(cmd, master, port, nl):
     if nl.capabilities['create_bond']:
         return True
+    (error, ) = compat_bond_ports(master, [(cmd, port)])
+    if error is not None:
+        raise error
+
+
+def compat_bond_ports(master, ports):
+    '''
+    Add or remove several bond ports with one open() of the
+    slaves file. `ports` is a list of `(cmd, ifname)`, where
+    `cmd` is 'add' or 'del'.
+
+    Every port is a separate write(), so one failed port doesn't
+    stop the rest. Returns the list of errors in the order of
+    `ports`: OSError for a failed port, `None` for the others.
+    '''
     remap = {'add': '+',
              'del': '-'}
-    cmd = remap[cmd]
-    with open(_BONDING_SLAVES % (master), 'w') as f:
-        f.write('%s%s' % (cmd, port))
+    try:
+        fd = os.open(_BONDING_SLAVES % (master), os.O_WRONLY)
+    except OSError as e:
+        return [e] * len(ports)
+    ret = []
+    try:
+        for (cmd, port) in ports:
+            try:
+                os.write(fd, ('%s%s' % (remap[cmd], port)).encode('utf-8'))
+                ret.append(None)
+            except OSError as e:
+                ret.append(e)
+    finally:
+        os.close(fd)
+    return ret
 
 
 def compat_get_master(name):
-    f = None
-
-    for i in (_BRIDGE_MASTER, _BONDING_MASTER):
+    # Both paths go through the symlink to the master device, that
+    # is resolved anew by every open(), so a master change is seen
+    # on the next call. The `master` link exists for bonding slaves
+    # (and for bridge ports on newer kernels); bridge ports of the
+    # older kernels have only brport/bridge.
+    for i in (_BONDING_MASTER, _BRIDGE_MASTER):
         try:
             try:
-                f = open(i % (name))
+                value = _sysfs_read(i % (name))
             except UnicodeEncodeError:
                 # a special case with python3 on Ubuntu 14
-                f = open(i % (name.encode('utf-8')))
-            break
-        except IOError:
-            pass
-
-    if f is not None:
-        master = int(f.read())
-        f.close()
-        return master
+                value = _sysfs_read(i % (name.encode('utf-8')))
+        except (IOError, OSError):
+            continue
+        return int(value)
 
 
 def get_interface_type(name):
@@ -508,17 +847,11 @@ def get_interface_type(name):
     '''
     # FIXME: support all interface types? Right now it is
     # not needed
-    try:
-        ifattrs = os.listdir('/sys/class/net/%s/' % (name))
-    except OSError as e:
-        if e.errno == 2:
-            return 'unknown'
-        else:
-            raise
-
-    if 'bonding' in ifattrs:
-        return 'bond'
-    elif 'bridge' in ifattrs:
-        return 'bridge'
-    else:
-        return 'unknown'
+    for (subdir, kind) in (('bonding', 'bond'), ('bridge', 'bridge')):
+        try:
+            os.stat('/sys/class/net/%s/%s' % (name, subdir))
+            return kind
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return 'unknown'
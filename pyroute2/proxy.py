@@ -59,18 +59,25 @@ class NetlinkProxy(object):
                 except Exception as e:
                     log.error(''.join(traceback.format_stack()))
                     log.error(traceback.format_exc())
-                    # errmsg
-                    if isinstance(e, (OSError, IOError)):
-                        code = e.errno
-                    elif isinstance(e, NetlinkError):
-                        code = e.code
-                    else:
-                        code = errno.ECOMM
-                    newmsg = struct.pack('HH', 2, 0)
-                    newmsg += msg.data[8:16]
-                    newmsg += struct.pack('I', code)
-                    newmsg += msg.data
-                    newmsg = struct.pack('I', len(newmsg) + 4) + newmsg
-                    return {'verdict': 'error',
-                            'data': newmsg}
+                    return error_verdict(msg, e)
         return None
+
+
+def error_verdict(msg, e):
+    '''
+    Build the 'error' verdict, NLMSG_ERROR for the request `msg`
+    failed with the exception `e`.
+    '''
+    if isinstance(e, (OSError, IOError)):
+        code = e.errno
+    elif isinstance(e, NetlinkError):
+        code = e.code
+    else:
+        code = errno.ECOMM
+    newmsg = struct.pack('HH', 2, 0)
+    newmsg += msg.data[8:16]
+    newmsg += struct.pack('I', code)
+    newmsg += msg.data
+    newmsg = struct.pack('I', len(newmsg) + 4) + newmsg
+    return {'verdict': 'error',
+            'data': newmsg}
@@ -0,0 +1,555 @@
+import os
+import time
+import shutil
+import struct
+import errno
+import signal
+import logging
+import tempfile
+import threading
+from pyroute2 import config
+from pyroute2.proxy import NetlinkProxy
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink.rtnl import RTMGRP_LINK
+from pyroute2.netlink.rtnl.ifinfmsg import IFF_UP
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.ifinfmsg import compat
+
+
+class TestSysfs(object):
+
+    def test_attr_names(self):
+        (_, cmds, names) = compat._SYSFS_ATTRS['bridge']
+        bridge = dict(zip(cmds, names))
+        assert bridge['IFLA_BR_FORWARD_DELAY'] == 'forward_delay'
+        assert bridge['IFLA_BR_MCAST_LAST_MEMBER_CNT'] == \
+            'multicast_last_member_count'
+        assert bridge['IFLA_BR_VLAN_DEFAULT_PVID'] == 'default_pvid'
+        assert 'IFLA_BR_PAD' not in bridge
+        assert 'IFLA_BR_FDB_FLUSH' not in bridge
+        (_, cmds, names) = compat._SYSFS_ATTRS['bond']
+        bond = dict(zip(cmds, names))
+        assert bond['IFLA_BOND_MODE'] == 'mode'
+        assert bond['IFLA_BOND_AD_LACP_RATE'] == 'lacp_rate'
+        assert 'IFLA_BOND_ACTIVE_SLAVE' not in bond
+
+    def test_read_batch_pool_after_fork(self):
+        workers = config.compat_sysfs_workers
+        config.compat_sysfs_workers = 2
+        names = ['ifindex'] * compat._SYSFS_POOL_MIN
+        try:
+            assert compat._sysfs_read_batch('/sys/class/net/lo',
+                                            names)[0] == b'1\n'
+            pid = os.fork()
+            if pid == 0:
+                # the inherited pool has no threads, so map() would
+                # block forever; the alarm kills the child instead
+                try:
+                    signal.alarm(10)
+                    ret = compat._sysfs_read_batch('/sys/class/net/lo',
+                                                   names)
+                    os._exit(0 if ret[0] == b'1\n' else 1)
+                except Exception:
+                    os._exit(1)
+            assert os.waitpid(pid, 0)[1] == 0
+        finally:
+            config.compat_sysfs_workers = workers
+
+
+def link_msg(index, ifname, kind, master=None):
+    msg = ifinfmsg()
+    msg['index'] = index
+    msg['attrs'] = [['IFLA_IFNAME', ifname],
+                    ['IFLA_LINKINFO', {'attrs': [['IFLA_INFO_KIND', kind]]}]]
+    if master is not None:
+        msg['attrs'].append(['IFLA_MASTER', master])
+    msg.encode()
+    ret = ifinfmsg(msg.data)
+    ret.decode()
+    return ret
+
+
+def link_request(msg_type, index, master=None, kind=None, data=None):
+    msg = ifinfmsg()
+    msg['header']['type'] = msg_type
+    msg['index'] = index
+    msg['attrs'] = []
+    if master is not None:
+        msg['attrs'].append(['IFLA_MASTER', master])
+    if kind is not None:
+        msg['attrs'].append(['IFLA_LINKINFO',
+                             {'attrs': [['IFLA_INFO_KIND', kind],
+                                        ['IFLA_INFO_DATA',
+                                         {'attrs': data}]]}])
+    msg.encode()
+    return msg
+
+
+class TestFixAttrs(object):
+
+    def setup_method(self):
+        self.attrs = dict(compat._SYSFS_ATTRS)
+        self.sysfs = tempfile.mkdtemp()
+        for (kind, ifname, values) in (('bridge', 'br0',
+                                        {'forward_delay': '1500\n',
+                                         'group_fwd_mask': '0x0\n'}),
+                                       ('bond', 'bond0',
+                                        {'mode': 'balance-rr 0\n',
+                                         'lacp_rate': 'fast 1\n'})):
+            (_, cmds, names) = compat._SYSFS_ATTRS[kind]
+            compat._SYSFS_ATTRS[kind] = (os.path.join(self.sysfs, '%s'),
+                                         cmds, names)
+            os.mkdir(os.path.join(self.sysfs, ifname))
+            for (name, value) in values.items():
+                with open(os.path.join(self.sysfs, ifname, name), 'w') as f:
+                    f.write(value)
+
+    def teardown_method(self):
+        compat._SYSFS_ATTRS.update(self.attrs)
+        shutil.rmtree(self.sysfs)
+
+    def test_fill(self):
+        msg = link_msg(2, 'br0', 'bridge')
+        compat.compat_fix_attrs(msg, True)
+        data = msg.get_attr('IFLA_LINKINFO').get_attr('IFLA_INFO_DATA')
+        assert data['attrs'] == [['IFLA_BR_FORWARD_DELAY', 1500],
+                                 ['IFLA_BR_GROUP_FWD_MASK', 0]]
+        msg = link_msg(3, 'bond0', 'bond')
+        compat.compat_fix_attrs(msg, True)
+        data = msg.get_attr('IFLA_LINKINFO').get_attr('IFLA_INFO_DATA')
+        assert data['attrs'] == [['IFLA_BOND_MODE', 0],
+                                 ['IFLA_BOND_AD_LACP_RATE', 1]]
+
+    def test_kernel_data(self):
+        msg = link_request(16, 2, kind='bridge',
+                           data=[['IFLA_BR_FORWARD_DELAY', 200]])
+        msg['attrs'].insert(0, ['IFLA_IFNAME', 'br0'])
+        msg.reset()
+        msg.encode()
+        msg = ifinfmsg(msg.data)
+        msg.decode()
+        compat.compat_fix_attrs(msg, True)
+        li = msg.get_attr('IFLA_LINKINFO')
+        data = [x[1] for x in li['attrs'] if x[0] == 'IFLA_INFO_DATA']
+        assert len(data) == 1
+        assert data[0].get_attr('IFLA_BR_FORWARD_DELAY') == 200
+
+
+class FakeRTNL(object):
+    '''
+    RawIPRSocket stand-in: every message put into `inbox`
+    makes the fd readable for one get() call.
+    '''
+    instances = []
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        self.groups = None
+        self.closed = False
+        self.inbox = []
+        self.requests = []
+        self.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *argv):
+        self.close()
+
+    def bind(self, groups=0):
+        self.groups = groups
+
+    def fileno(self):
+        return self.rfd
+
+    def put(self, event, ifname):
+        msg = ifinfmsg()
+        msg['event'] = event
+        msg['attrs'] = [['IFLA_IFNAME', ifname]]
+        self.inbox.append(msg)
+        os.write(self.wfd, b'x')
+
+    def get(self):
+        os.read(self.rfd, 1)
+        return [self.inbox.pop(0)]
+
+    def nlm_request(self, msg, msg_type, msg_flags):
+        self.requests.append((msg, msg_type, msg_flags))
+        return []
+
+    def close(self):
+        self.closed = True
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class WarningCounter(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class TestSync(object):
+
+    def setup_method(self):
+        self.rtnl = compat.RawIPRSocket
+        self.timeout = compat._SYNC_TIMEOUT
+        compat.RawIPRSocket = FakeRTNL
+        compat._SYNC_TIMEOUT = 0.2
+        FakeRTNL.instances = []
+        self.warnings = WarningCounter()
+        compat.log.addHandler(self.warnings)
+
+    def teardown_method(self):
+        compat.log.removeHandler(self.warnings)
+        compat.RawIPRSocket = self.rtnl
+        compat._SYNC_TIMEOUT = self.timeout
+
+    def request(self, ifname):
+        msg = ifinfmsg()
+        msg['header']['type'] = compat.RTM_NEWLINK
+        msg['attrs'] = [['IFLA_IFNAME', ifname]]
+        return msg
+
+    def test_event(self):
+
+        @compat.sync
+        def f(msg):
+            # the socket must be ready before the external call
+            (ipr, ) = FakeRTNL.instances
+            assert ipr.groups == RTMGRP_LINK
+            ipr.put('RTM_NEWLINK', 'eth1')
+            ipr.put('RTM_DELLINK', 'eth0')
+            ipr.put('RTM_NEWLINK', 'eth0')
+            return 'ok'
+
+        start = time.time()
+        assert f(self.request('eth0')) == 'ok'
+        assert time.time() - start < compat._SYNC_TIMEOUT
+        assert FakeRTNL.instances[0].closed
+        assert FakeRTNL.instances[0].inbox == []
+        assert self.warnings.count == 0
+
+    def test_timeout(self):
+
+        @compat.sync
+        def f(msg):
+            FakeRTNL.instances[0].put('RTM_NEWLINK', 'eth1')
+            return 'ok'
+
+        start = time.time()
+        assert f(self.request('eth0')) == 'ok'
+        assert time.time() - start >= compat._SYNC_TIMEOUT
+        assert FakeRTNL.instances[0].closed
+        assert self.warnings.count == 1
+
+    def test_exception(self):
+
+        @compat.sync
+        def f(msg):
+            raise OSError(errno.EPERM, 'test')
+
+        start = time.time()
+        try:
+            f(self.request('eth0'))
+        except OSError as e:
+            assert e.errno == errno.EPERM
+        else:
+            raise AssertionError('exception is not forwarded')
+        assert time.time() - start < compat._SYNC_TIMEOUT
+        assert FakeRTNL.instances[0].closed
+        assert self.warnings.count == 0
+
+    def test_socket_per_call(self):
+
+        @compat.sync
+        def f(msg):
+            FakeRTNL.instances[-1].put('RTM_NEWLINK', 'eth0')
+
+        f(self.request('eth0'))
+        f(self.request('eth0'))
+        assert len(FakeRTNL.instances) == 2
+        assert all(x.closed for x in FakeRTNL.instances)
+
+
+class FakeNL(object):
+    '''
+    The proxy namespace of an IPRoute socket. The plugins must
+    not call link(), see below.
+    '''
+
+    def __init__(self, links):
+        self.links = links
+        self.proxy = None
+        self.capabilities = {'create_bridge': False,
+                             'create_bond': False,
+                             'create_dummy': False,
+                             'provide_master': False,
+                             'provide_linkinfo': False}
+
+    def get_links(self, index):
+        return [self.links[index]]
+
+    def link(self, command, index, **kwarg):
+        # a trap for the plugins: like IPRoute.link(), the request
+        # goes through the proxy again, and deadlocks on its lock
+        return self.proxy.handle(link_request(compat.RTM_NEWLINK, index))
+
+
+class FakeSubprocess(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def check_call(self, argv, **kwarg):
+        self.calls.append(argv)
+        # the sync socket is the first one created
+        FakeRTNL.instances[0].put('RTM_DELLINK', argv[-1])
+
+
+class TestDellink(object):
+
+    def setup_method(self):
+        self.rtnl = compat.RawIPRSocket
+        self.subprocess = compat.subprocess
+        self.bonding_masters = compat._BONDING_MASTERS
+        self.timeout = compat._SYNC_TIMEOUT
+        compat.RawIPRSocket = FakeRTNL
+        compat.subprocess = FakeSubprocess()
+        compat._SYNC_TIMEOUT = 0.2
+        FakeRTNL.instances = []
+        self.nl = FakeNL({2: link_msg(2, 'br0', 'bridge'),
+                          3: link_msg(3, 'bond0', 'bond')})
+        self.proxy = NetlinkProxy(policy='return', nl=self.nl)
+        self.proxy.pmap = {compat.RTM_DELLINK: compat.proxy_dellink,
+                           compat.RTM_NEWLINK: compat.proxy_newlink}
+        self.nl.proxy = self.proxy
+
+    def teardown_method(self):
+        compat.RawIPRSocket = self.rtnl
+        compat.subprocess = self.subprocess
+        compat._BONDING_MASTERS = self.bonding_masters
+        compat._SYNC_TIMEOUT = self.timeout
+
+    def dellink(self, index):
+        # run in a thread: a deadlock on the proxy lock
+        # must fail the test, not hang it
+        ret = []
+        t = threading.Thread(target=lambda: ret.append(
+            self.proxy.handle(link_request(compat.RTM_DELLINK, index))))
+        t.daemon = True
+        t.start()
+        t.join(5)
+        assert not t.is_alive(), 'proxy_dellink() deadlock'
+        return ret[0]
+
+    def check_down(self, index):
+        (request, ) = FakeRTNL.instances[1].requests
+        (msg, msg_type, msg_flags) = request
+        assert msg['index'] == index
+        assert msg['change'] == IFF_UP
+        assert msg['flags'] == 0
+        assert msg_type == compat.RTM_NEWLINK
+        assert msg_flags == NLM_F_REQUEST | NLM_F_ACK
+
+    def test_del_bridge(self):
+        ret = self.dellink(2)
+        assert ret['verdict'] == 'return'
+        assert compat.subprocess.calls == [['brctl', 'delbr', 'br0']]
+        self.check_down(2)
+
+    def test_del_bond(self):
+        with tempfile.NamedTemporaryFile() as f:
+            compat._BONDING_MASTERS = f.name
+            ret = self.dellink(3)
+            assert f.read() == b'-bond0'
+        assert ret['verdict'] == 'return'
+        self.check_down(3)
+
+
+class TestSetlink(object):
+
+    def setup_method(self):
+        self.dirs = (compat._BRIDGE_DIR, compat._BONDING_DIR)
+        self.sysfs = tempfile.mkdtemp()
+        compat._BRIDGE_DIR = compat._BONDING_DIR = \
+            os.path.join(self.sysfs, '%s')
+        for (ifname, names) in (('br0', ('forward_delay',
+                                         'multicast_snooping')),
+                                ('bond0', ('mode', 'lacp_rate'))):
+            os.mkdir(os.path.join(self.sysfs, ifname))
+            for name in names:
+                open(os.path.join(self.sysfs, ifname, name), 'w').close()
+        self.nl = FakeNL({2: link_msg(2, 'br0', 'bridge'),
+                          3: link_msg(3, 'bond0', 'bond')})
+
+    def teardown_method(self):
+        (compat._BRIDGE_DIR, compat._BONDING_DIR) = self.dirs
+        shutil.rmtree(self.sysfs)
+
+    def read(self, ifname, name):
+        with open(os.path.join(self.sysfs, ifname, name), 'r') as f:
+            return f.read()
+
+    def test_bridge(self):
+        request = link_request(19, 2, kind='bridge',
+                               data=[['IFLA_BR_FORWARD_DELAY', 1500],
+                                     ['IFLA_BR_MCAST_SNOOPING', 0]])
+        ret = compat.proxy_setlink(request, self.nl)
+        assert ret['verdict'] == 'forward'
+        assert self.read('br0', 'forward_delay') == '1500'
+        assert self.read('br0', 'multicast_snooping') == '0'
+
+    def test_bond(self):
+        request = link_request(19, 3, kind='bond',
+                               data=[['IFLA_BOND_MODE', 4],
+                                     ['IFLA_BOND_AD_LACP_RATE', 1]])
+        ret = compat.proxy_setlink(request, self.nl)
+        assert ret['verdict'] == 'forward'
+        assert self.read('bond0', 'mode') == '4'
+        assert self.read('bond0', 'lacp_rate') == '1'
+
+    def test_error(self):
+        request = link_request(19, 2, kind='bridge',
+                               data=[['IFLA_BR_FORWARD_DELAY', 1500],
+                                     ['IFLA_BR_HELLO_TIME', 200]])
+        try:
+            compat.proxy_setlink(request, self.nl)
+        except OSError as e:
+            assert e.errno == errno.ENOENT
+        else:
+            raise AssertionError('error is not raised')
+        # the rest of the attributes is written anyway
+        assert self.read('br0', 'forward_delay') == '1500'
+
+
+class BondNL(FakeNL):
+    '''
+    Port masters come from the port commands applied before,
+    like the kernel reports them after the slaves file writes.
+    '''
+
+    def __init__(self, links):
+        super(BondNL, self).__init__(links)
+        self.log = []
+        self.bond_ports = compat.compat_bond_ports
+
+    def compat_bond_ports(self, master, ports):
+        errors = self.bond_ports(master, ports)
+        for ((cmd, port), error) in zip(ports, errors):
+            if error is None:
+                self.log.append((master, cmd, port))
+        return errors
+
+    def get_links(self, index):
+        (msg, ) = super(BondNL, self).get_links(index)
+        ifname = msg.get_attr('IFLA_IFNAME')
+        kind = msg.get_attr('IFLA_LINKINFO').get_attr('IFLA_INFO_KIND')
+        master = None
+        for (bond, cmd, port) in self.log:
+            if port == ifname:
+                master = bond if cmd == 'add' else None
+        if master is not None:
+            (master, ) = [x for (x, y) in self.links.items()
+                          if y.get_attr('IFLA_IFNAME') == master]
+        return [link_msg(index, ifname, kind, master)]
+
+
+class TestSetlinkBatch(object):
+
+    def setup_method(self):
+        self.bonding_slaves = compat._BONDING_SLAVES
+        self.bond_ports = compat.compat_bond_ports
+        self.sysfs = tempfile.mkdtemp()
+        compat._BONDING_SLAVES = os.path.join(self.sysfs, '%s')
+        # bond1 has no slaves file
+        open(os.path.join(self.sysfs, 'bond0'), 'w').close()
+        self.nl = BondNL({3: link_msg(3, 'bond0', 'bond'),
+                          4: link_msg(4, 'bond1', 'bond'),
+                          5: link_msg(5, 'eth0', 'veth'),
+                          6: link_msg(6, 'eth1', 'veth'),
+                          7: link_msg(7, 'eth2', 'veth')})
+        self.nl.log.append(('bond0', 'add', 'eth1'))
+        compat.compat_bond_ports = self.nl.compat_bond_ports
+
+    def teardown_method(self):
+        compat._BONDING_SLAVES = self.bonding_slaves
+        compat.compat_bond_ports = self.bond_ports
+        shutil.rmtree(self.sysfs)
+
+    def error(self, ret):
+        assert ret['verdict'] == 'error'
+        return struct.unpack_from('I', ret['data'], 16)[0]
+
+    def test_errors_per_request(self):
+        setlink = 19
+        requests = [link_request(setlink, 5, master=3),
+                    link_request(setlink, 7, master=4),
+                    link_request(setlink, 6, master=0),
+                    # no such interface
+                    link_request(setlink, 8, master=3),
+                    link_request(setlink, 7, master=3)]
+        ret = compat.proxy_setlink_batch(requests, self.nl)
+
+        assert len(ret) == len(requests)
+        assert ret[0] is None
+        assert self.error(ret[1]) == errno.ENOENT
+        assert ret[2] is None
+        assert self.error(ret[3]) == errno.ECOMM
+        assert ret[4] is None
+        assert self.nl.log[1:] == [('bond0', 'add', 'eth0'),
+                                   ('bond0', 'del', 'eth1'),
+                                   ('bond0', 'add', 'eth2')]
+
+    def test_add_del(self):
+        setlink = 19
+        requests = [link_request(setlink, 5, master=3),
+                    link_request(setlink, 7, master=3),
+                    link_request(setlink, 5, master=0)]
+        ret = compat.proxy_setlink_batch(requests, self.nl)
+        batch = self.nl.log[1:]
+        # the same requests one by one
+        del self.nl.log[1:]
+        single = [compat.proxy_setlink_batch([x], self.nl)[0]
+                  for x in requests]
+
+        assert ret == single == [None, None, None]
+        assert batch == self.nl.log[1:] == [('bond0', 'add', 'eth0'),
+                                            ('bond0', 'add', 'eth2'),
+                                            ('bond0', 'del', 'eth0')]
+
+    def test_group_per_master(self):
+        opened = []
+        bond_ports = self.nl.compat_bond_ports
+
+        def compat_bond_ports(master, ports):
+            opened.append((master, ports))
+            return bond_ports(master, ports)
+
+        compat.compat_bond_ports = compat_bond_ports
+        setlink = 19
+        requests = [link_request(setlink, 5, master=3),
+                    link_request(setlink, 7, master=3),
+                    link_request(setlink, 6, master=4),
+                    link_request(setlink, 6, master=0)]
+        ret = compat.proxy_setlink_batch(requests, self.nl)
+
+        assert ret[:2] == [None, None]
+        assert self.error(ret[2]) == errno.ENOENT
+        assert ret[3] is None
+        assert opened == [('bond0', [('add', 'eth0'), ('add', 'eth2')]),
+                          ('bond1', [('add', 'eth1')]),
+                          ('bond0', [('del', 'eth1')])]
+
+    def test_bond_port_error(self):
+        try:
+            compat.compat_bond_port('add', 'bond1', 'eth0', self.nl)
+        except OSError as e:
+            assert e.errno == errno.ENOENT
+        else:
+            raise AssertionError('error is not raised')